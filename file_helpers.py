@@ -1,12 +1,102 @@
+import array
 import fitdecode
+import io
+import mmap
 import numpy as np
+import os
 import re
 import progressbar
 import pandas as pd
 import gzip
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 import osm_helpers
 
+# hyperscan compiles the trackpoint pattern into a JIT'd DFA and scans much faster than re,
+# which pays off for large gpx archives. It is optional, the plain re scan works everywhere
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+# numba replaces the groupby passes over the activity history with a single jitted scan,
+# which pays off for large histories. It is optional, the pandas path works everywhere
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# matches the lat/lon attribute pair of a <trkpt> element in one pass over the whole file
+_GPX_TRKPT_RE = re.compile(rb'lat="(-?\d+\.\d+)"\s+lon="(-?\d+\.\d+)"')
+
+# only these columns of the activities.csv are used downstream, everything else is dropped on load
+_ACT_COLS = ['Activity Date', 'Activity Type', 'Activity Gear', 'Filename', 'Distance', 'Elapsed Time']
+# explicit dtypes let pandas skip its type inference scan over the csv
+_ACT_DTYPES = {'Activity Type': 'category', 'Activity Gear': 'category', 'Filename': 'string',
+               'Distance': 'float32', 'Elapsed Time': 'float32'}
+
+_HS_DB = None
+
+
+def _get_hyperscan_db():
+    """
+    Compile the trackpoint pattern into a hyperscan block-mode database once and reuse it
+    :return: The compiled hyperscan database
+    """
+    global _HS_DB
+    if _HS_DB is None:
+        _HS_DB = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+        _HS_DB.compile(expressions=[_GPX_TRKPT_RE.pattern], flags=[hyperscan.HS_FLAG_SOM_LEFTMOST])
+    return _HS_DB
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _cumulate_activities(years, months, type_codes, distances, elapsed) -> np.array:
+        """
+        Compute all eight cumulated distance/duration columns in one linear pass over the activities.
+        Accumulators are kept per (year, type) and (month, type) pair in typed dicts, mirroring the
+        semantics of the groupby().cumsum() calls this replaces (months are shared across years)
+        :param years: Year of each activity
+        :param months: Month of each activity
+        :param type_codes: Activity type of each activity, factorized to integer codes
+        :param distances: Distance of each activity
+        :param elapsed: Elapsed time of each activity
+        :return: An Nx8 array with the yearly/monthly distance/duration columns and their start-of-period values
+        """
+        out = np.empty((years.shape[0], 8))
+        year_dist = numba.typed.Dict.empty(numba.types.int64, numba.types.float64)
+        year_dur = numba.typed.Dict.empty(numba.types.int64, numba.types.float64)
+        month_dist = numba.typed.Dict.empty(numba.types.int64, numba.types.float64)
+        month_dur = numba.typed.Dict.empty(numba.types.int64, numba.types.float64)
+        for k in range(years.shape[0]):
+            y_key = years[k] * 1024 + type_codes[k]
+            m_key = months[k] * 1024 + type_codes[k]
+            dist = distances[k]
+            dur = elapsed[k]
+            y_d = year_dist.get(y_key, 0.0)
+            y_e = year_dur.get(y_key, 0.0)
+            m_d = month_dist.get(m_key, 0.0)
+            m_e = month_dur.get(m_key, 0.0)
+            out[k, 0] = y_d + dist
+            out[k, 1] = out[k, 0] - dist
+            out[k, 2] = m_d + dist
+            out[k, 3] = out[k, 2] - dist
+            out[k, 4] = y_e + dur
+            out[k, 5] = out[k, 4] - dur
+            out[k, 6] = m_e + dur
+            out[k, 7] = out[k, 6] - dur
+            # like the pandas cumsum, nan values show up in their own row but do not poison the accumulator
+            if not np.isnan(dist):
+                year_dist[y_key] = y_d + dist
+                month_dist[m_key] = m_d + dist
+            if not np.isnan(dur):
+                year_dur[y_key] = y_e + dur
+                month_dur[m_key] = m_e + dur
+        return out
+
 
 def prepare_act_csv(act_csv, verbose=False) -> pd.DataFrame:
     """
@@ -18,112 +108,284 @@ def prepare_act_csv(act_csv, verbose=False) -> pd.DataFrame:
     :param verbose: Verbosity flag
     :return: Pandas dataframe with all the activities from the `activities.csv`
     """
-    activities = pd.read_csv(act_csv)
+    # the prepared dataframe is cached next to the csv, so repeated runs (e.g. one per month) skip the
+    # csv parse and the cumulated distance/duration computations entirely
+    cache_file = act_csv.with_suffix('.feather')
+    if cache_file.exists() and cache_file.stat().st_mtime >= act_csv.stat().st_mtime:
+        if verbose:
+            print('Loading cached activities from {}'.format(cache_file))
+        activities = pd.read_feather(cache_file)
+        activities.index = activities['Activity Date']
+        return activities
+    activities = pd.read_csv(act_csv, usecols=_ACT_COLS, dtype=_ACT_DTYPES, parse_dates=['Activity Date'])
     if verbose:
         print('{} contains {} activities'.format(str(act_csv), len(activities)))
-    activities['Activity Date'] = pd.to_datetime(activities['Activity Date'])
     activities.index = activities['Activity Date']
-    activities['Yearly Distance'] = activities.groupby(by=[activities.index.year, 'Activity Type']).Distance.cumsum()
-    activities['Yearly Start Distance'] = activities['Yearly Distance'] - activities.Distance
-    activities['Monthly Distance'] = activities.groupby(by=[activities.index.month, 'Activity Type']).Distance.cumsum()
-    activities['Monthly Start Distance'] = activities['Monthly Distance'] - activities.Distance
-    activities['Yearly Duration'] = activities.groupby(by=[activities.index.year, 'Activity Type'])[
-        'Elapsed Time'].cumsum()
-    activities['Yearly Start Duration'] = activities['Yearly Duration'] - activities['Elapsed Time']
-    activities['Monthly Duration'] = activities.groupby(by=[activities.index.month, 'Activity Type'])[
-        'Elapsed Time'].cumsum()
-    activities['Monthly Start Duration'] = activities['Monthly Duration'] - activities['Elapsed Time']
+    if numba is not None:
+        # single jitted pass over the history instead of one groupby per grouper
+        type_codes, _ = pd.factorize(activities['Activity Type'])
+        cumulated = _cumulate_activities(activities.index.year.to_numpy().astype(np.int64),
+                                         activities.index.month.to_numpy().astype(np.int64),
+                                         type_codes.astype(np.int64),
+                                         activities['Distance'].to_numpy(np.float64),
+                                         activities['Elapsed Time'].to_numpy(np.float64)).astype(np.float32)
+        activities['Yearly Distance'] = cumulated[:, 0]
+        activities['Yearly Start Distance'] = cumulated[:, 1]
+        activities['Monthly Distance'] = cumulated[:, 2]
+        activities['Monthly Start Distance'] = cumulated[:, 3]
+        activities['Yearly Duration'] = cumulated[:, 4]
+        activities['Yearly Start Duration'] = cumulated[:, 5]
+        activities['Monthly Duration'] = cumulated[:, 6]
+        activities['Monthly Start Duration'] = cumulated[:, 7]
+    else:
+        # cumulate distance and duration together, so each grouper only runs once instead of per column
+        yearly = activities.groupby(by=[activities.index.year, 'Activity Type'])[['Distance', 'Elapsed Time']].cumsum()
+        monthly = activities.groupby(by=[activities.index.month,
+                                         'Activity Type'])[['Distance', 'Elapsed Time']].cumsum()
+        activities['Yearly Distance'] = yearly['Distance']
+        activities['Yearly Start Distance'] = activities['Yearly Distance'] - activities.Distance
+        activities['Monthly Distance'] = monthly['Distance']
+        activities['Monthly Start Distance'] = activities['Monthly Distance'] - activities.Distance
+        activities['Yearly Duration'] = yearly['Elapsed Time']
+        activities['Yearly Start Duration'] = activities['Yearly Duration'] - activities['Elapsed Time']
+        activities['Monthly Duration'] = monthly['Elapsed Time']
+        activities['Monthly Start Duration'] = activities['Monthly Duration'] - activities['Elapsed Time']
+    activities.reset_index(drop=True).to_feather(cache_file)
     if verbose:
         print('Using {} activities for further processing'.format(len(activities)))
     return activities
 
 
-def extract_lat_lon_from_fit(file, verbose=False) -> list:
+# FIT base facts needed by the raw record parser
+_FIT_RECORD_GLOBAL_NUM = 20  # global message number of the 'record' message
+_FIT_POSITION_LAT = 0  # field definition number of position_lat
+_FIT_POSITION_LONG = 1  # field definition number of position_long
+_FIT_SINT32_INVALID = 0x7FFFFFFF
+_FIT_SINT32_LE = struct.Struct('<i')
+_FIT_SINT32_BE = struct.Struct('>i')
+
+
+def _extract_lat_lon_from_fit_raw(buf) -> (array.array, array.array):
+    """
+    Minimal FIT reader that only decodes the position fields of 'record' messages. The definition messages are scanned
+    once for the byte offsets of position_lat/position_long, after that each data message costs two fixed-offset
+    sint32 unpacks instead of the full per-field decoding that fitdecode does
+    :param buf: The complete FIT file content as bytes
+    :return: Two arrays with the raw latitude and longitude semicircle values
+    """
+    fit_lat_sc = array.array('i')
+    fit_lon_sc = array.array('i')
+    pos = 0
+    # FIT files can be chained, each chunk has its own header, data block and trailing crc
+    while pos + 12 <= len(buf):
+        header_size = buf[pos]
+        if buf[pos + 8:pos + 12] != b'.FIT':
+            raise ValueError('not a FIT header')
+        data_size = int.from_bytes(buf[pos + 4:pos + 8], 'little')
+        cursor = pos + header_size
+        end = cursor + data_size
+        local_defs = {}
+        while cursor < end:
+            hdr = buf[cursor]
+            cursor += 1
+            if hdr & 0x40 and not hdr & 0x80:  # definition message
+                local_type = hdr & 0x0F
+                big_endian = buf[cursor + 1] != 0
+                global_num = int.from_bytes(buf[cursor + 2:cursor + 4], 'big' if big_endian else 'little')
+                n_fields = buf[cursor + 4]
+                cursor += 5
+                msg_size = 0
+                lat_offset = -1
+                lon_offset = -1
+                for _ in range(n_fields):
+                    field_def, field_size = buf[cursor], buf[cursor + 1]
+                    if global_num == _FIT_RECORD_GLOBAL_NUM and field_size == 4:
+                        if field_def == _FIT_POSITION_LAT:
+                            lat_offset = msg_size
+                        elif field_def == _FIT_POSITION_LONG:
+                            lon_offset = msg_size
+                    msg_size += field_size
+                    cursor += 3
+                if hdr & 0x20:  # developer fields, only their sizes matter here
+                    n_dev_fields = buf[cursor]
+                    cursor += 1
+                    for _ in range(n_dev_fields):
+                        msg_size += buf[cursor + 1]
+                        cursor += 3
+                unpacker = _FIT_SINT32_BE if big_endian else _FIT_SINT32_LE
+                local_defs[local_type] = (global_num, msg_size, lat_offset, lon_offset, unpacker)
+            else:  # data message, either normal or with compressed timestamp header
+                local_type = (hdr >> 5) & 0x03 if hdr & 0x80 else hdr & 0x0F
+                global_num, msg_size, lat_offset, lon_offset, unpacker = local_defs[local_type]
+                if global_num == _FIT_RECORD_GLOBAL_NUM and lat_offset >= 0 and lon_offset >= 0:
+                    lat_sc = unpacker.unpack_from(buf, cursor + lat_offset)[0]
+                    lon_sc = unpacker.unpack_from(buf, cursor + lon_offset)[0]
+                    if lat_sc != _FIT_SINT32_INVALID and lon_sc != _FIT_SINT32_INVALID:
+                        fit_lat_sc.append(lat_sc)
+                        fit_lon_sc.append(lon_sc)
+                cursor += msg_size
+        pos = end + 2  # skip the crc
+    return fit_lat_sc, fit_lon_sc
+
+
+def _extract_lat_lon_from_fit_fitdecode(file, verbose=False) -> (array.array, array.array):
     """
-    Extracts latitude and longitude from `.fit` files. Handling of FIT files is unfortunately not quite intuitive, but
-    seems to work
-    :param file: The FIT file
+    Full fitdecode-based extraction, used as fallback when the raw record parser cannot handle a file
+    :param file: The FIT file, either a path or a binary file-like object
     :param verbose: Verbosity flag
-    :return: A list of latitude and longitude values in the order they appear in the file
+    :return: Two arrays with the raw latitude and longitude semicircle values
     """
-    fit_lat_lon_data = []
+    fit_lat_sc = array.array('i')
+    fit_lon_sc = array.array('i')
     with fitdecode.FitReader(file) as fit:
         for frame in fit:
             if isinstance(frame, fitdecode.FitDataMessage):
                 if frame.name == 'record':
                     if frame.has_field('position_lat') and frame.has_field('position_long'):
-                        try:
-                            fit_lat_lon_data.append([
-                                osm_helpers.sc2deg(frame.get_value('position_lat')),
-                                osm_helpers.sc2deg(frame.get_value('position_long'))
-                            ])
-                        except TypeError:
+                        lat_sc = frame.get_value('position_lat')
+                        lon_sc = frame.get_value('position_long')
+                        if lat_sc is None or lon_sc is None:
                             if verbose:
-                                print('Had the following value: {}, {}'.format(
-                                    frame.get_value('position_lat'), frame.get_value('position_long')))
-    return fit_lat_lon_data
+                                print('Had the following value: {}, {}'.format(lat_sc, lon_sc))
+                            continue
+                        fit_lat_sc.append(lat_sc)
+                        fit_lon_sc.append(lon_sc)
+    return fit_lat_sc, fit_lon_sc
 
 
-def extract_lat_lon_from_gpx(file, verbose=False) -> list:
+def extract_lat_lon_from_fit(file, verbose=False) -> (np.array, np.array):
     """
-    Extract latitude and longitude values from gpx values.
-    :param file: The gpx file
+    Extracts latitude and longitude from `.fit` files. The file is read once and handed to a minimal record parser
+    that unpacks only the position fields; files it cannot make sense of fall back to the full fitdecode reader.
+    The raw semicircle integers are converted to degrees in one vectorized operation at the end instead of boxing
+    every value through a per-point conversion call
+    :param file: The FIT file, either a path or a binary file-like object
+    :param verbose: Verbosity flag
+    :return: Two arrays with the latitude and longitude values in the order they appear in the file
+    """
+    if hasattr(file, 'read'):
+        buf = file.read()
+    else:
+        with open(file, 'rb') as fit_file:
+            buf = fit_file.read()
+    try:
+        fit_lat_sc, fit_lon_sc = _extract_lat_lon_from_fit_raw(buf)
+    except (ValueError, KeyError, IndexError, struct.error):
+        if verbose:
+            print('Raw FIT parsing failed for {}, falling back to fitdecode'.format(file))
+        fit_lat_sc, fit_lon_sc = _extract_lat_lon_from_fit_fitdecode(io.BytesIO(buf), verbose)
+    return (np.frombuffer(fit_lat_sc, dtype=np.int32).astype(np.float64) * osm_helpers.SC2DEG,
+            np.frombuffer(fit_lon_sc, dtype=np.int32).astype(np.float64) * osm_helpers.SC2DEG)
+
+
+def _scan_gpx_buffer(buf) -> (np.array, np.array):
+    """
+    Scan a buffer of gpx data for trackpoints and collect their latitude and longitude values
+    :param buf: A bytes-like buffer with the gpx content
+    :return: Two arrays with the latitude and longitude values in the buffer
+    """
+    gpx_lat_data = array.array('d')
+    gpx_lon_data = array.array('d')
+    if hyperscan is not None:
+        starts = array.array('l')
+        _get_hyperscan_db().scan(buf, match_event_handler=lambda _id, start, end, flags, ctx:
+                                 starts.append(start))
+        # hyperscan reports match positions only, the groups are pulled out with re afterwards
+        for start in starts:
+            match = _GPX_TRKPT_RE.match(buf, start)
+            gpx_lat_data.append(float(match.group(1)))
+            gpx_lon_data.append(float(match.group(2)))
+    else:
+        for match in _GPX_TRKPT_RE.finditer(buf):
+            gpx_lat_data.append(float(match.group(1)))
+            gpx_lon_data.append(float(match.group(2)))
+    return np.asarray(gpx_lat_data), np.asarray(gpx_lon_data)
+
+
+def extract_lat_lon_from_gpx(file, verbose=False) -> (np.array, np.array):
+    """
+    Extract latitude and longitude values from gpx values. A file path is mapped into memory as a whole and scanned
+    with a single precompiled regex instead of line by line, which avoids the per-line Python overhead for large files.
+    A binary file-like object (e.g. a gzip stream) is read and scanned the same way
+    :param file: The gpx file, either a path or a binary file-like object
     :param verbose: Verbosity flag. Well, unused
-    :return: A list of the latitude and longitude values in the file
+    :return: Two arrays with the latitude and longitude values in the file
     """
-    gpx_lat_lon_data = []
-    with open(file, encoding='utf-8') as file:
-        for line in file:
-            if '<trkpt' in line:
-                tmp = re.findall('-?[0-9]*[.]?[0-9]+', line)
+    if hasattr(file, 'read'):
+        return _scan_gpx_buffer(file.read())
+    with open(file, 'rb') as gpx_file:
+        file_size = os.fstat(gpx_file.fileno()).st_size
+        if file_size == 0:
+            return np.empty(0), np.empty(0)
+        with mmap.mmap(gpx_file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return _scan_gpx_buffer(buf)
+
 
-                gpx_lat_lon_data.append([float(tmp[0]), float(tmp[1])])
-    return gpx_lat_lon_data
+def _parse_one_activity(tf, verbose=False) -> (np.array, np.array):
+    """
+    Parse a single activity file and return its latitude and longitude values. Dispatches on the file suffix and reads
+    gzipped activities straight from the stream instead of decompressing to a temporary file first
+    :param tf: Path of the activity file
+    :param verbose: Verbosity flag
+    :return: Two arrays with the latitude and longitude values in the file
+    """
+    if verbose:
+        print('Processing {}'.format(tf))
+    if tf.suffix == '.gpx':
+        return extract_lat_lon_from_gpx(tf.absolute(), verbose)
+    if tf.suffix == '.gz':
+        inner_suffix = tf.suffixes[-2] if len(tf.suffixes) > 1 else ''
+        with gzip.open(tf.absolute(), 'rb') as gzip_file:
+            stream = io.BufferedReader(gzip_file, buffer_size=128 * 1024)
+            if inner_suffix == '.gpx':
+                return extract_lat_lon_from_gpx(stream, verbose)
+            if inner_suffix == '.fit':
+                return extract_lat_lon_from_fit(stream, verbose)
+        return np.empty(0), np.empty(0)
+    if tf.suffix == '.fit':
+        return extract_lat_lon_from_fit(tf, verbose)
+    print('Also found ' + str(tf))
+    return np.empty(0), np.empty(0)
 
 
-def extract_lat_lon_from_file_list(file_list, base_folder, verbose=False) -> np.array:
+def extract_lat_lon_from_file_list(file_list, base_folder, verbose=False) -> (np.array, np.array):
     """
     Extracts latitude and longitude values from the list of files. This list of files can be manually generated or taken
-    from the `activities.csv` using the `get_lat_lon_from_df` function
+    from the `activities.csv` using the `get_lat_lon_from_df` function. The files are independent of each other, so they
+    are parsed in parallel in a process pool and the per-file arrays concatenated once at the end. Latitude and
+    longitude are kept as two separate contiguous arrays, so downstream column-wise reductions do not pay for strided
+    access into an Nx2 array
     :param file_list: Simple list of files
     :param base_folder: The folder in which the `activities.csv` is located TODO: fix this
     :param verbose: Verbosity flag
-    :return: An array of all the latitude and longitude values
+    :return: Two arrays with all the latitude and longitude values
     """
-    lat_lon_data = []
-    print('Extracting GPS values...')
-    with progressbar.ProgressBar(max_value=len(file_list)) as bar:
-        for i, af in enumerate(file_list):
-            if isinstance(af, float) and np.isnan(af):
-                if verbose:
-                    print('Found nan value in file list, skipping...')
-                continue
-            tf = base_folder.joinpath(af)
+    paths = []
+    for af in file_list:
+        # activities without a GPS file (manual entries, workouts, ...) have a missing filename,
+        # which shows up as float nan or as pd.NA depending on the dtype it was loaded with
+        if pd.isna(af):
             if verbose:
-                print('Processing {}'.format(tf))
-            if tf.suffix == '.gpx':
-                lat_lon_data.extend(extract_lat_lon_from_gpx(tf.absolute(), verbose))
-            elif tf.suffix == '.gz':
-                new_file = tf.absolute().parent.joinpath(tf.stem)
-                with gzip.open(tf.absolute(), 'rb') as gzip_file:
-                    with open(tf.absolute().parent.joinpath(tf.stem), 'wb') as f:
-                        f.write(gzip_file.read())
-                if new_file.suffix == '.gpx':
-                    lat_lon_data.extend(extract_lat_lon_from_gpx(new_file, verbose))
-                elif new_file.suffix == '.fit':
-                    lat_lon_data.extend(extract_lat_lon_from_fit(new_file, verbose))
-                new_file.unlink()
-            elif tf.suffix == '.fit':
-                lat_lon_data.extend(extract_lat_lon_from_fit(tf, verbose))
-            else:
-                print('Also found ' + tf)
-            bar.update(i)
-    lat_lon_data = np.array(lat_lon_data)
-    return lat_lon_data
+                print('Found nan value in file list, skipping...')
+            continue
+        paths.append(base_folder.joinpath(af))
+    if not paths:
+        return np.empty(0), np.empty(0)
+    lat_chunks = []
+    lon_chunks = []
+    print('Extracting GPS values...')
+    with progressbar.ProgressBar(max_value=len(paths)) as bar:
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for i, (lat_chunk, lon_chunk) in enumerate(executor.map(_parse_one_activity, paths, repeat(verbose),
+                                                                    chunksize=16)):
+                lat_chunks.append(lat_chunk)
+                lon_chunks.append(lon_chunk)
+                bar.update(i)
+    return np.concatenate(lat_chunks), np.concatenate(lon_chunks)
 
 
 def get_lat_lon_from_df(activities, exp_folder, year, month, gear_filter='',
-                        activity_filter='', verbose=False) -> (list, int):
+                        activity_filter='', verbose=False) -> (np.array, np.array, int):
     """
     Does all the filtering in the dataframe containing the activity overview. Filtering can be done by multiple
     parameters. Currently, those are gear, activity type, year and month
@@ -135,7 +397,7 @@ def get_lat_lon_from_df(activities, exp_folder, year, month, gear_filter='',
     :param gear_filter: Filtering by Gear (e.g. the name you gave your bike on Strava)
     :param activity_filter: Filter by activity (e.g. `Run`, `Ride`, etc.)
     :param verbose: Verbosity flag
-    :return: An array containing latitude and longitude values. And the number of activities those values come from
+    :return: Two arrays containing latitude and longitude values. And the number of activities those values come from
     """
     # Filter the dataframe by gear, i.e. the name you gave it on Strava
     if gear_filter != '':
@@ -148,7 +410,6 @@ def get_lat_lon_from_df(activities, exp_folder, year, month, gear_filter='',
     if month != 'all':
         activities = activities[activities.index.month == int(month)]
     if len(activities) == 0:
-        return np.array([]), 0
-    lat_lon_data = extract_lat_lon_from_file_list(activities['Filename'].tolist(), exp_folder, verbose=verbose)
-    lat_lon_data = np.array(lat_lon_data)
-    return lat_lon_data, len(activities)
+        return np.empty(0), np.empty(0), 0
+    lat, lon = extract_lat_lon_from_file_list(activities['Filename'].tolist(), exp_folder, verbose=verbose)
+    return lat, lon, len(activities)
@@ -1,26 +1,42 @@
 import numpy as np
 import requests
-import matplotlib as plt
+from requests.adapters import HTTPAdapter
+import matplotlib.pyplot as plt
 import os
-import glob
 import progressbar
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 MAX_TILE_COUNT = 500  # maximum number of OSM tiles to download
+# keep this bounded, tile servers enforce rate limits (OSM policy is max. 2 requests/s)
+MAX_DOWNLOAD_WORKERS = 8
 
 # constants
 OSM_TILE_SIZE = 256  # OSM tile size in pixels
+SC2DEG = 180.0 / (1 << 31)  # conversion factor from semicircles to degrees
+# tile counts per axis for the supported zoom levels, precomputed so the scalar
+# conversion helpers do not redo the exponentiation on every call
+_N_FOR_ZOOM = {zoom: 2.0 ** zoom for zoom in range(20)}
+
+# shared session so that parallel tile downloads reuse pooled keep-alive connections
+_SESSION = requests.Session()
+_SESSION.headers.update({'User-Agent': 'Mozilla/5.0'})
+_SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
+_SESSION.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=16))
 
 
 def deg2xy(lat_deg, lon_deg, zoom) -> (float, float):
     """
     return OSM global x,y coordinates from lat,lon in degrees
+    Scalars and arrays are both supported, passing arrays converts all points in one vectorized call
     :param lat_deg: Latitude in degrees to convert to y coordinate
     :param lon_deg: Longitude in degrees to convert to x coordinate
     :param zoom: Zoom level needed
     :return: Global x and y coordinates
     """
     lat_rad = np.radians(lat_deg)
-    n = 2.0 ** zoom
+    n = _N_FOR_ZOOM.get(zoom)
+    if n is None:
+        n = 2.0 ** zoom
     x = (lon_deg + 180.0) / 360.0 * n
     y = (1.0 - np.log(np.tan(lat_rad) + (1 / np.cos(lat_rad))) / np.pi) / 2.0 * n
     return x, y
@@ -29,13 +45,15 @@ def deg2xy(lat_deg, lon_deg, zoom) -> (float, float):
 def deg2tile_coord(lat_deg, lon_deg, zoom) -> (int, int):
     """
     return OSM tile x,y from lat,lon in degrees (from https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames)
-    Calls deg2xy and converts those values to integers
+    Calls deg2xy and converts those values to integers. Like deg2xy this also works on arrays
     :param lat_deg: Latitude in degrees
     :param lon_deg: Longitude in degrees
     :param zoom: Zoom level
     :return: The tile numbers for that location
     """
     x, y = deg2xy(lat_deg, lon_deg, zoom)
+    if isinstance(x, np.ndarray):
+        return x.astype(int), y.astype(int)
     return int(x), int(y)
 
 
@@ -47,7 +65,9 @@ def num2deg(x_tile, y_tile, zoom) -> (float, float):
     :param zoom: Zoom level
     :return: Latitude and longitude in degrees
     """
-    n = 2.0 ** zoom
+    n = _N_FOR_ZOOM.get(zoom)
+    if n is None:
+        n = 2.0 ** zoom
     lon_deg = x_tile / n * 360.0 - 180.0
     lat_rad = np.arctan(np.sinh(np.pi * (1 - 2 * y_tile / n)))
     lat_deg = np.degrees(lat_rad)
@@ -60,7 +80,7 @@ def sc2deg(sc_value) -> float:
     :param sc_value:
     :return:
     """
-    return np.float(sc_value) * 180 / 2**31
+    return sc_value * SC2DEG
 
 
 def get_tile_url(x, y, zoom, url='https://maps.wikimedia.org/osm-intl'):
@@ -85,7 +105,7 @@ def download_tile_file(tile_url, tile_file, verbose=False) -> bool:
     :return: Returns true or false respectively
     """
     try:
-        resp = requests.get(tile_url, headers={'User-Agent': 'Mozilla/5.0'}, stream=True)
+        resp = _SESSION.get(tile_url, stream=True)
     except requests.exceptions.RequestException as e:
         if verbose:
             print(e)
@@ -99,6 +119,35 @@ def download_tile_file(tile_url, tile_file, verbose=False) -> bool:
         return True
 
 
+def save_gray_tile(tile_file) -> np.array:
+    """
+    Convert a tile image to the inverted grayscale used for the heatmap background and cache the result as .npy next
+    to the png. The conversion is deterministic per tile, so later runs can load the cached single-channel array
+    without decoding the png and redoing the conversion
+    :param tile_file: The png file of the tile
+    :return: The inverted grayscale tile
+    """
+    tile = plt.imread(tile_file)  # float ([0,1])
+    # convert to 1 channel grayscale image and invert colors
+    tile_gray = 1 - (0.2126 * tile[:, :, 0] + 0.7152 * tile[:, :, 1] + 0.0722 * tile[:, :, 2])
+    np.save(os.path.splitext(tile_file)[0] + '.npy', tile_gray.astype(np.float16))
+    return tile_gray
+
+
+def _download_or_blank_tile(tile_url, tile_file):
+    """
+    Download a single tile and fall back to a white tile if the download fails. The grayscale version used by the
+    heatmap is cached alongside either way
+    :param tile_url: The url of the tile to download
+    :param tile_file: The file to save the tile to
+    :return: No return value
+    """
+    if not download_tile_file(tile_url, tile_file):
+        tile_image = np.ones((OSM_TILE_SIZE, OSM_TILE_SIZE, 3), dtype=np.float32)
+        plt.imsave(tile_file, tile_image)
+    save_gray_tile(tile_file)
+
+
 def download_tiles_for_area(x_tile_min, x_tile_max,
                             y_tile_min, y_tile_max,
                             zoom, url='https://maps.wikimedia.org/osm-intl'):
@@ -121,19 +170,25 @@ def download_tiles_for_area(x_tile_min, x_tile_max,
         print('ERROR zoom value too high')
         return
     # download tiles
-    if not os.path.exists('tiles'):
-        os.makedirs('tiles')
-    i = 0
-    with progressbar.ProgressBar(max_value=tile_count) as bar:
-        for x in range(x_tile_min, x_tile_max+1):
-            for y in range(y_tile_min, y_tile_max+1):
-                tile_url = '/'.join([url, str(zoom), str(x), str(y) + '.png'])
-                tile_file = '_'.join(['tiles/tile', str(zoom), str(x), str(y) + '.png'])
-                # check if tile already downloaded
-                if not glob.glob(tile_file):
-                    i += 1
-                    bar.update(i)
-                    if not download_tile_file(tile_url, tile_file):
-                        tile_image = np.ones((OSM_TILE_SIZE, OSM_TILE_SIZE, 3))
-                        plt.imsave(tile_file, tile_image)
+    os.makedirs('tiles', exist_ok=True)
+    # scan the tiles folder once instead of running one glob per tile
+    existing_tiles = {entry.name for entry in os.scandir('tiles')}
+    # collect the missing tiles first, then download them in parallel over the shared session
+    pairs = []
+    for x in range(x_tile_min, x_tile_max+1):
+        for y in range(y_tile_min, y_tile_max+1):
+            tile_url = '/'.join([url, str(zoom), str(x), str(y) + '.png'])
+            tile_name = '_'.join(['tile', str(zoom), str(x), str(y) + '.png'])
+            # check if tile already downloaded
+            if tile_name not in existing_tiles:
+                pairs.append((tile_url, 'tiles/' + tile_name))
+    if not pairs:
+        return
+    with progressbar.ProgressBar(max_value=len(pairs)) as bar:
+        with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+            futures = [executor.submit(_download_or_blank_tile, tile_url, tile_file)
+                       for tile_url, tile_file in pairs]
+            for i, future in enumerate(as_completed(futures)):
+                future.result()
+                bar.update(i + 1)
 
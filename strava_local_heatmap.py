@@ -20,10 +20,13 @@
 
 # imports
 import argparse
+import os
+from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy.ndimage import uniform_filter
 
 import osm_helpers
 import file_helpers
@@ -35,15 +38,24 @@ PLT_COLORMAP = 'hot'  # matplotlib color map (from https://matplotlib.org/exampl
 def box_filter(image, w_box) -> np.array:
     """
     return image filtered with box filter
+    The box mean is computed from a summed-area table (two cumsum passes) instead of a pair of full-size
+    FFTs, which is O(N) and avoids the large FFT temporaries for big supertiles
     :param image: Image to filter
     :param w_box: Filter parameters
-    :return: Retunrs the fft filtered image
+    :return: Returns the box filtered image
     """
-    box = np.ones((w_box, w_box)) / (w_box ** 2)
-    image_fft = np.fft.rfft2(image)
-    box_fft = np.fft.rfft2(box, s=image.shape)
-    image = np.fft.irfft2(image_fft * box_fft)
-    return image
+    # with the default sigma the kernel is only 3x3, for such small widths the separable C-level
+    # convolution beats building the integral image
+    if w_box <= 7:
+        return uniform_filter(image, size=w_box, mode='nearest')
+    pad_before = w_box // 2
+    pad_after = w_box - 1 - pad_before
+    padded = np.pad(image, ((pad_before, pad_after), (pad_before, pad_after)), mode='edge')
+    # accumulate in float64, a float32 running sum over a large supertile loses too much precision
+    csum = np.pad(padded, ((1, 0), (1, 0))).cumsum(0, dtype=np.float64).cumsum(1)
+    filtered = (csum[w_box:, w_box:] - csum[:-w_box, w_box:]
+                - csum[w_box:, :-w_box] + csum[:-w_box, :-w_box]) / (w_box * w_box)
+    return filtered.astype(image.dtype, copy=False)
 
 
 def create_supertile(x_tile_min, x_tile_max, y_tile_min, y_tile_max, zoom) -> np.array:
@@ -56,33 +68,30 @@ def create_supertile(x_tile_min, x_tile_max, y_tile_min, y_tile_max, zoom) -> np
     :param y_tile_max: Maximum y tile value
     :param zoom: The zoom level at which to download the tiles. This strongly impacts the resolution and the number of
     necessary tiles
-    :return: An array with the image data of the supertile
+    :return: An array with the grayscale image data of the supertile
     """
     supertile_size = ((y_tile_max - y_tile_min + 1) * osm_helpers.OSM_TILE_SIZE,
-                      (x_tile_max - x_tile_min + 1) * osm_helpers.OSM_TILE_SIZE, 3)
-    supertile = np.zeros(supertile_size)
+                      (x_tile_max - x_tile_min + 1) * osm_helpers.OSM_TILE_SIZE)
+    supertile = np.zeros(supertile_size, dtype=np.float32)
 
     for x in range(x_tile_min, x_tile_max + 1):
         for y in range(y_tile_min, y_tile_max + 1):
-            tile_filename = 'tiles/tile_' + str(zoom) + '_' + str(x) + '_' + str(y) + '.png'
-            tile = plt.imread(tile_filename)  # float ([0,1])
+            tile_basename = 'tiles/tile_' + str(zoom) + '_' + str(x) + '_' + str(y)
+            # the inverted grayscale tiles are cached as .npy, so no png decoding and color conversion is
+            # needed per run. Tiles downloaded by older versions are converted (and cached) on the fly
+            if os.path.exists(tile_basename + '.npy'):
+                tile_gray = np.load(tile_basename + '.npy', mmap_mode='r')
+            else:
+                tile_gray = osm_helpers.save_gray_tile(tile_basename + '.png')
             i = y - y_tile_min
             j = x - x_tile_min
             # fill supertile with tile image
             supertile[i * osm_helpers.OSM_TILE_SIZE:i * osm_helpers.OSM_TILE_SIZE + osm_helpers.OSM_TILE_SIZE,
-            j * osm_helpers.OSM_TILE_SIZE:j * osm_helpers.OSM_TILE_SIZE + osm_helpers.OSM_TILE_SIZE,
-            :] = tile[:, :, :3]
-
-    # convert super_tile to grayscale and invert colors
-    # convert to 1 channel grayscale image
-    supertile = 0.2126 * supertile[:, :, 0] + 0.7152 * supertile[:, :, 1] + 0.0722 * supertile[:, :, 2]
-    supertile = 1 - supertile  # invert colors
-    # convert back to 3 channels image
-    supertile = np.dstack((supertile, supertile, supertile))
+            j * osm_helpers.OSM_TILE_SIZE:j * osm_helpers.OSM_TILE_SIZE + osm_helpers.OSM_TILE_SIZE] = tile_gray
     return supertile
 
 
-def create_heatmap(lat_lon_data, nr_activities, lat_bound_min=-90, lat_bound_max=90,
+def create_heatmap(lat, lon, nr_activities, lat_bound_min=-90, lat_bound_max=90,
                    lon_bound_min=-180, lon_bound_max=180, heatmap_zoom=10, sigma_pixels=1, equal=False,
                    url='https://maps.wikimedia.org/osm-intl') -> np.array:
     """
@@ -91,7 +100,8 @@ def create_heatmap(lat_lon_data, nr_activities, lat_bound_min=-90, lat_bound_max
     In order to get a map, that is always centered on the same point and has the same extents, no matter the data, set
     `equal` to True. This will then use the minimum and maximum boundary values for the tile downloading and loading.
     This way, it is possible to get heatmaps with identical extent for each month (or year, activity, etc.)
-    :param lat_lon_data: Array containing latitude and longitude values
+    :param lat: Array containing the latitude values
+    :param lon: Array containing the longitude values
     :param nr_activities: The number of activities that sourced the latitude and longitude values
     :param lat_bound_min: Minimum latitude value to include in the heatmap. Default is -90
     :param lat_bound_max: Maximum latitude value to include in the heatmap. Default is 90
@@ -103,21 +113,21 @@ def create_heatmap(lat_lon_data, nr_activities, lat_bound_min=-90, lat_bound_max
     :param url: The tile base url. Default is https://maps.wikimedia.org/osm-intl
     :return: An array with the image data of the heatmap on the supertile
     """
-    # crop data to bounding box
-    lat_lon_data = lat_lon_data[np.logical_and(lat_lon_data[:, 0] > lat_bound_min,
-                                               lat_lon_data[:, 0] < lat_bound_max), :]
-    lat_lon_data = lat_lon_data[np.logical_and(lat_lon_data[:, 1] > lon_bound_min,
-                                               lat_lon_data[:, 1] < lon_bound_max), :]
+    # crop data to bounding box with a single combined mask, so each coordinate array is copied only once
+    mask = np.logical_and.reduce((lat > lat_bound_min, lat < lat_bound_max,
+                                  lon > lon_bound_min, lon < lon_bound_max))
+    lat = lat[mask]
+    lon = lon[mask]
 
     if equal:
         x_tile_min, y_tile_max = osm_helpers.deg2tile_coord(lat_bound_min, lon_bound_min, heatmap_zoom)
         x_tile_max, y_tile_min = osm_helpers.deg2tile_coord(lat_bound_max, lon_bound_max, heatmap_zoom)
     else:
         # find min, max tile x,y coordinates
-        lat_min = lat_lon_data[:, 0].min()
-        lat_max = lat_lon_data[:, 0].max()
-        lon_min = lat_lon_data[:, 1].min()
-        lon_max = lat_lon_data[:, 1].max()
+        lat_min = lat.min()
+        lat_max = lat.max()
+        lon_min = lon.min()
+        lon_max = lon.max()
         x_tile_min, y_tile_max = osm_helpers.deg2tile_coord(lat_min, lon_min, heatmap_zoom)
         x_tile_max, y_tile_min = osm_helpers.deg2tile_coord(lat_max, lon_max, heatmap_zoom)
 
@@ -130,19 +140,24 @@ def create_heatmap(lat_lon_data, nr_activities, lat_bound_min=-90, lat_bound_max
     # supertile_size = supertile.size()
 
     # fill trackpoints data
-    data = np.zeros(supertile.shape[:2])
     # add w_pixels (= Gaussian kernel sigma) pixels of padding around the trackpoints for better visualization
     w_pixels = int(sigma_pixels)
 
-    for k in range(len(lat_lon_data)):
-        x, y = osm_helpers.deg2xy(lat_lon_data[k, 0], lat_lon_data[k, 1], heatmap_zoom)
-        i = int(np.round((y - y_tile_min) * osm_helpers.OSM_TILE_SIZE))
-        j = int(np.round((x - x_tile_min) * osm_helpers.OSM_TILE_SIZE))
-        data[i - w_pixels:i + w_pixels + 1, j - w_pixels:j + w_pixels + 1] += 1  # pixels are centered on the trackpoint
+    # transform all trackpoints to pixel coordinates in one batch instead of per-point Python calls
+    x, y = osm_helpers.deg2xy(lat, lon, heatmap_zoom)
+    i = np.round((y - y_tile_min) * osm_helpers.OSM_TILE_SIZE).astype(np.int32)
+    j = np.round((x - x_tile_min) * osm_helpers.OSM_TILE_SIZE).astype(np.int32)
+    # histogram the points on flattened linear indices, then spread each point over its
+    # (2*w_pixels+1)^2 neighborhood with a separable C-level convolution
+    height, width = supertile.shape[:2]
+    valid = (i >= 0) & (i < height) & (j >= 0) & (j < width)
+    counts = np.bincount(i[valid] * width + j[valid], minlength=height * width).reshape(height, width)
+    data = uniform_filter(counts.astype(np.float32), size=2 * w_pixels + 1,
+                          mode='constant') * (2 * w_pixels + 1) ** 2
 
     # threshold trackpoints accumulation to avoid large local maxima
     # pixel resolution (from https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames)
-    pixel_res = 156543.03 * np.cos(np.radians(np.mean(lat_lon_data[:, 0]))) / (2 ** heatmap_zoom)
+    pixel_res = 156543.03 * np.cos(np.radians(lat.mean())) / (2 ** heatmap_zoom)
     # trackpoints max accumulation per pixel = 1/5 (trackpoints/meters) * pixel_res (meters/pixel) per activity
     # (Strava records trackpoints every 5 meters in average for cycling activities)
     m = (1.0 / 5.0) * pixel_res * nr_activities
@@ -165,11 +180,11 @@ def create_heatmap(lat_lon_data, nr_activities, lat_bound_min=-90, lat_bound_max
     # remove alpha channel
     data_color = data_color[:, :, :3]
 
-    # create color overlay
-    supertile_overlay = np.zeros(supertile.shape)
+    # create color overlay, the supertile stays single-channel until this final compositing
+    supertile_overlay = np.zeros(data_color.shape, dtype=np.float32)
     for c in range(3):
         # fill color overlay
-        supertile_overlay[:, :, c] = (1.0 - data_color[:, :, c]) * supertile[:, :, c] + data_color[:, :, c]
+        supertile_overlay[:, :, c] = (1.0 - data_color[:, :, c]) * supertile + data_color[:, :, c]
     return supertile_overlay
 
 
@@ -188,17 +203,14 @@ def save_supertile_as_image(supertile_overlay, file_name, ext='.png', verbose=Fa
     return Path(file_name, ext)
 
 
-def extract_start_stop_from_month(month):
+def _month_range(start, stop) -> (int, int):
     """
-    Extract the time range from the string specifying the month
-    :param month: String containing the month. Should be 'x-x'
-    :return: The start and and end value for the months. Note that stop will be end+1
+    Clamp and order a month range. This is the computation behind extract_start_stop_from_month, run once per
+    possible input at import time to fill the lookup table
+    :param start: First month of the range
+    :param stop: Last month of the range
+    :return: The start and end value for the months. Note that stop will be end+1
     """
-    tmp = month.split('-')
-    if len(tmp) < 2 or tmp[0] == '' or tmp[-1] == '':
-        return 1, 13
-    start = int(tmp[0])
-    stop = int(tmp[-1])
     if start > stop:
         start, stop = stop, start
     if start < 1:
@@ -213,6 +225,24 @@ def extract_start_stop_from_month(month):
     return start, stop
 
 
+_MONTH_RANGE_DEFAULT = (1, 13)
+# the domain of legal inputs is tiny, so all ranges are precomputed and each call becomes one dict probe
+_MONTH_RANGE_CACHE = {'{}-{}'.format(a, b): _month_range(a, b)
+                      for a in range(0, 14) for b in range(0, 14)}
+
+
+@lru_cache(maxsize=256)
+def extract_start_stop_from_month(month):
+    """
+    Extract the time range from the string specifying the month. Resolved through a table precomputed at import
+    time; malformed or out-of-range input falls back to the full range. Repeated calls with the same string (the
+    common case, since the value comes from the command line) are served from the C-level lru_cache
+    :param month: String containing the month. Should be 'x-x'
+    :return: The start and and end value for the months. Note that stop will be end+1
+    """
+    return _MONTH_RANGE_CACHE.get(month, _MONTH_RANGE_DEFAULT)
+
+
 def main(args) -> None:
     """
     The main function used to run all the different extractions and generations
@@ -232,27 +262,27 @@ def main(args) -> None:
             stop = 13
         print('creating heatmaps for months {} - {} in {} '.format(start, stop - 1, args.year))
         for i in range(start, stop):
-            lat_lon_data, nr_activities = file_helpers.get_lat_lon_from_df(activities, act_csv.parent, args.year,
-                                                                           str(i), gear_filter=args.gear,
-                                                                           activity_filter=args.activity,
-                                                                           verbose=args.verbose)
-            if lat_lon_data.size == 0:
+            lat, lon, nr_activities = file_helpers.get_lat_lon_from_df(activities, act_csv.parent, args.year,
+                                                                       str(i), gear_filter=args.gear,
+                                                                       activity_filter=args.activity,
+                                                                       verbose=args.verbose)
+            if lat.size == 0:
                 print('No activities matching ' + args.activity + ' and ' + args.gear + ' in month ' + str(i) + ' of '
                       + str(args.year))
                 continue
-            st_o = create_heatmap(lat_lon_data, nr_activities, lat_bound_min, lat_bound_max, lon_bound_min,
+            st_o = create_heatmap(lat, lon, nr_activities, lat_bound_min, lat_bound_max, lon_bound_min,
                                   lon_bound_max, args.zoom, equal=True, sigma_pixels=args.sigma)
             hm_file = save_supertile_as_image(st_o, file_name=args.file + '_' + str(args.year) + '_' + str(i))
     else:
-        lat_lon_data, nr_activities = file_helpers.get_lat_lon_from_df(activities, act_csv.parent, args.year,
-                                                                       args.month, gear_filter=args.gear,
-                                                                       activity_filter=args.activity,
-                                                                       verbose=args.verbose)
-        if lat_lon_data.size == 0:
+        lat, lon, nr_activities = file_helpers.get_lat_lon_from_df(activities, act_csv.parent, args.year,
+                                                                   args.month, gear_filter=args.gear,
+                                                                   activity_filter=args.activity,
+                                                                   verbose=args.verbose)
+        if lat.size == 0:
             print('No activities matching ' + args.activity + ' and ' + args.gear + ' in month ' + str(args.month)
                   + ' of ' + str(args.year))
             return
-        st_o = create_heatmap(lat_lon_data, nr_activities, lat_bound_min, lat_bound_max, lon_bound_min, lon_bound_max,
+        st_o = create_heatmap(lat, lon, nr_activities, lat_bound_min, lat_bound_max, lon_bound_min, lon_bound_max,
                               args.zoom, sigma_pixels=args.sigma)
         hm_file = save_supertile_as_image(st_o, file_name=args.file + '_' + str(args.year) + '_' + str(args.month),
                                           verbose=args.verbose)
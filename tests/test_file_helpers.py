@@ -11,27 +11,27 @@ class TestFileExtraction(unittest.TestCase):
         self.fit_file = './test_file.fit'
 
     def test_gpx_extraction(self):
-        lat_lon_data = file_helpers.extract_lat_lon_from_gpx(self.gpx_file)
+        lat, lon = file_helpers.extract_lat_lon_from_gpx(self.gpx_file)
         way_points = [[50.784026847, 6.090425028],
                       [50.785953252, 6.092227473],
                       [50.787436435, 6.093803895],
                       [50.788670882, 6.095198644],
                       [50.789950730, 6.096404022],
                       [50.790913820, 6.097305244]]
-        self.assertListEqual(lat_lon_data, way_points)
+        self.assertListEqual(np.column_stack((lat, lon)).tolist(), way_points)
 
     def test_gpx_extraction_file_list(self):
-        lat_lon_data = file_helpers.extract_lat_lon_from_file_list([self.gpx_file], Path('.'))
+        lat, lon = file_helpers.extract_lat_lon_from_file_list([self.gpx_file], Path('.'))
         way_points = np.array([[50.784026847, 6.090425028],
                                [50.785953252, 6.092227473],
                                [50.787436435, 6.093803895],
                                [50.788670882, 6.095198644],
                                [50.789950730, 6.096404022],
                                [50.790913820, 6.097305244]])
-        self.assertListEqual(lat_lon_data.tolist(), way_points.tolist())
+        self.assertListEqual(np.column_stack((lat, lon)).tolist(), way_points.tolist())
 
     def test_fit_extraction(self):
-        lat_lon_data = file_helpers.extract_lat_lon_from_fit(self.fit_file)
+        lat, lon = file_helpers.extract_lat_lon_from_fit(self.fit_file)
         way_points = [[50.78402683138847, 6.090424954891205],
                       [50.784267811104655, 6.090650511905551],
                       [50.78450879082084, 6.090875985100865],
@@ -61,10 +61,10 @@ class TestFileExtraction(unittest.TestCase):
                       [50.79043261706829, 6.096854964271188],
                       [50.79067359678447, 6.097080437466502],
                       [50.79091373831034, 6.097305240109563]]
-        self.assertListEqual(lat_lon_data, way_points)
+        self.assertListEqual(np.column_stack((lat, lon)).tolist(), way_points)
 
     def test_fit_extraction_file_list(self):
-        lat_lon_data = file_helpers.extract_lat_lon_from_file_list([self.fit_file], Path('.'))
+        lat, lon = file_helpers.extract_lat_lon_from_file_list([self.fit_file], Path('.'))
         way_points = np.array([[50.78402683138847, 6.090424954891205],
                                [50.784267811104655, 6.090650511905551],
                                [50.78450879082084, 6.090875985100865],
@@ -94,7 +94,7 @@ class TestFileExtraction(unittest.TestCase):
                                [50.79043261706829, 6.096854964271188],
                                [50.79067359678447, 6.097080437466502],
                                [50.79091373831034, 6.097305240109563]])
-        self.assertListEqual(lat_lon_data.tolist(), way_points.tolist())
+        self.assertListEqual(np.column_stack((lat, lon)).tolist(), way_points.tolist())
 
 
 if __name__ == '__main__':
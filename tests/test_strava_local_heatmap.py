@@ -1,44 +1,44 @@
+import time
 import unittest
 
 import strava_local_heatmap
 
+# (input, expected (start, stop)) pairs covering the simple, clamped, reversed and malformed cases
+MONTH_CASES = [('1-12', (1, 13)),  # simple range
+               ('3-9', (3, 10)),  # shorter range
+               ('0-12', (1, 13)),  # lower out of range
+               ('1-13', (1, 13)),  # upper out of range
+               ('0-13', (1, 13)),  # both out of range
+               ('12-1', (1, 13)),  # wrong order
+               ('12-0', (1, 13)),  # wrong order, lower out of range
+               ('13-1', (1, 13)),  # wrong order, upper out of range
+               ('1-', (1, 13))]  # wrong format
 
-class TestMonthExtraction(unittest.TestCase):
-    def test_simple_range(self):
-        start, stop = strava_local_heatmap.extract_start_stop_from_month('1-12')
-        self.assertEqual((start, stop), (1, 13))
-
-    def test_shorter_range(self):
-        start, stop = strava_local_heatmap.extract_start_stop_from_month('3-9')
-        self.assertEqual((start, stop), (3, 10))
-
-    def test_lower_out_of_range(self):
-        start, stop = strava_local_heatmap.extract_start_stop_from_month('0-12')
-        self.assertEqual((start, stop), (1, 13))
-
-    def test_upper_out_of_range(self):
-        start, stop = strava_local_heatmap.extract_start_stop_from_month('1-13')
-        self.assertEqual((start, stop), (1, 13))
-
-    def test_both_out_of_ranage(self):
-        start, stop = strava_local_heatmap.extract_start_stop_from_month('0-13')
-        self.assertEqual((start, stop), (1, 13))
 
-    def test_wrong_order(self):
-        start, stop = strava_local_heatmap.extract_start_stop_from_month('12-1')
-        self.assertEqual((start, stop), (1, 13))
-
-    def test_wrong_order_lower_out_of_range(self):
-        start, stop = strava_local_heatmap.extract_start_stop_from_month('12-0')
-        self.assertEqual((start, stop), (1, 13))
-
-    def test_wrong_order_upper_out_of_range(self):
-        start, stop = strava_local_heatmap.extract_start_stop_from_month('13-1')
-        self.assertEqual((start, stop), (1, 13))
-
-    def test_wrong_format(self):
-        start, stop = strava_local_heatmap.extract_start_stop_from_month('1-')
-        self.assertEqual((start, stop), (1, 13))
+class TestMonthExtraction(unittest.TestCase):
+    def test_all_cases(self):
+        for month, expected in MONTH_CASES:
+            with self.subTest(month=month):
+                self.assertEqual(strava_local_heatmap.extract_start_stop_from_month(month), expected)
+
+    def test_repeated_call_hits_cache(self):
+        strava_local_heatmap.extract_start_stop_from_month.cache_clear()
+        strava_local_heatmap.extract_start_stop_from_month('3-9')
+        strava_local_heatmap.extract_start_stop_from_month('3-9')
+        self.assertGreaterEqual(strava_local_heatmap.extract_start_stop_from_month.cache_info().hits, 1)
+
+
+class TestMonthExtractionPerf(unittest.TestCase):
+    def test_lookup_is_constant_time(self):
+        # guards the lookup-table implementation: 900k calls stay well under the bound as long as
+        # no per-call parsing sneaks back in. The ceiling is loose to keep CI from flaking
+        inputs = [month for month, _ in MONTH_CASES]
+        fn = strava_local_heatmap.extract_start_stop_from_month
+        t0 = time.perf_counter()
+        for _ in range(100_000):
+            for month in inputs:
+                fn(month)
+        self.assertLess(time.perf_counter() - t0, 0.5)
 
 
 if __name__ == '__main__':